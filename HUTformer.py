@@ -2,10 +2,10 @@ import torch
 from torch import nn
 from torch import Tensor
 import torch.nn.functional as F
-from einops import rearrange
 import numpy as np
 import math
 import warnings
+import contextlib
 
 def _no_grad_trunc_normal_(tensor, mean, std, a, b):
     # Cut & paste from PyTorch official master until it's in a few official releases - RW
@@ -76,6 +76,10 @@ class WindowAttention(nn.Module):
         pretrained_window_size (tuple[int]): The height and width of the window in pre-training.
     """
 
+    # bumped whenever any instance drops its cached eval bias, so holders of that tensor (e.g. a captured
+    # CUDA graph) can tell it has been replaced with a single integer comparison
+    bias_generation = 0
+
     def __init__(self, dim, window_size, num_heads, qkv_bias=True, attn_drop=0., proj_drop=0.,
                  pretrained_window_size=[0, 0]):
 
@@ -86,6 +90,7 @@ class WindowAttention(nn.Module):
         self.num_heads = num_heads
 
         self.logit_scale = nn.Parameter(torch.log(10 * torch.ones((num_heads, 1, 1))), requires_grad=True)
+        self.register_buffer("logit_scale_max", torch.log(torch.tensor(1. / 0.01, dtype=torch.float32)), persistent=False)
 
         # mlp to generate continuous relative position bias
         self.cpb_mlp = nn.Sequential(nn.Linear(2, 512, bias=True),
@@ -93,47 +98,91 @@ class WindowAttention(nn.Module):
                                      nn.Linear(512, num_heads, bias=False))
 
         # get relative_coords_table
-        relative_coords_h = torch.arange(-(self.window_size[0] - 1), self.window_size[0], dtype=torch.float32)
-        relative_coords_w = torch.arange(-(self.window_size[1] - 1), self.window_size[1], dtype=torch.float32)
-        relative_coords_table = torch.stack(
-            torch.meshgrid([relative_coords_h,
-                            relative_coords_w])).permute(1, 2, 0).contiguous().unsqueeze(0)  # 1, 2*Wh-1, 2*Ww-1, 2
+        relative_coords_h = np.arange(-(self.window_size[0] - 1), self.window_size[0], dtype=np.float32)
+        relative_coords_w = np.arange(-(self.window_size[1] - 1), self.window_size[1], dtype=np.float32)
+        relative_coords_table = np.stack(
+            np.meshgrid(relative_coords_h, relative_coords_w, indexing='ij'), axis=-1)[None]  # 1, 2*Wh-1, 2*Ww-1, 2
         if pretrained_window_size[0] > 0:
-            relative_coords_table[:, :, :, 0] /= (pretrained_window_size[0] - 1)
-            relative_coords_table[:, :, :, 1] /= (pretrained_window_size[1] - 1)
+            relative_coords_table /= np.array([pretrained_window_size[0] - 1, pretrained_window_size[1] - 1], dtype=np.float32)
         else:
-            relative_coords_table[:, :, :, 0] /= (self.window_size[0] - 1)
-            relative_coords_table[:, :, :, 1] /= (self.window_size[1] - 1)
+            relative_coords_table /= np.array([self.window_size[0] - 1, self.window_size[1] - 1], dtype=np.float32)
         relative_coords_table *= 8  # normalize to -8, 8
-        relative_coords_table = torch.sign(relative_coords_table) * torch.log2(
-            torch.abs(relative_coords_table) + 1.0) / np.log2(8)
+        relative_coords_table = np.sign(relative_coords_table) * np.log2(
+            np.abs(relative_coords_table) + 1.0) / np.log2(8, dtype=np.float32)
 
-        self.register_buffer("relative_coords_table", relative_coords_table)
+        self.register_buffer("relative_coords_table", torch.from_numpy(relative_coords_table))
 
         # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
+        coords_h = np.arange(self.window_size[0], dtype=np.int64)
+        coords_w = np.arange(self.window_size[1], dtype=np.int64)
+        coords = np.stack(np.meshgrid(coords_h, coords_w, indexing='ij'))  # 2, Wh, Ww
+        coords_flatten = coords.reshape(2, -1)  # 2, Wh*Ww
         relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
+        relative_coords = relative_coords.transpose(1, 2, 0).copy()  # Wh*Ww, Wh*Ww, 2
         relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
         relative_coords[:, :, 1] += self.window_size[1] - 1
         relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
+        relative_position_index = torch.from_numpy(relative_coords.sum(-1))  # Wh*Ww, Wh*Ww
         self.register_buffer("relative_position_index", relative_position_index)
+        self.register_buffer("relative_position_index_flat", relative_position_index.view(-1), persistent=False)
 
         self.qkv = nn.Linear(dim, dim * 3, bias=False)
         if qkv_bias:
-            self.q_bias = nn.Parameter(torch.zeros(dim))
-            self.v_bias = nn.Parameter(torch.zeros(dim))
+            # one q/k/v bias parameter, the key slice is held at zero by the mask
+            self.qkv_bias = nn.Parameter(torch.zeros(dim * 3))
+            self.register_buffer("qkv_bias_mask", torch.cat((torch.ones(dim), torch.zeros(dim), torch.ones(dim))),
+                                 persistent=False)
         else:
-            self.q_bias = None
-            self.v_bias = None
+            self.qkv_bias = None
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
-        self.softmax = nn.Softmax(dim=-1)
+        self._cached_bias = None
+
+    def _drop_cached_bias(self):
+        self._cached_bias = None
+        WindowAttention.bias_generation += 1
+
+    def train(self, mode=True):
+        self._drop_cached_bias()
+        return super().train(mode)
+
+    def _apply(self, fn, *args, **kwargs):
+        self._drop_cached_bias()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._drop_cached_bias()
+        # checkpoints from before q_bias/v_bias were merged into qkv_bias
+        if prefix + 'q_bias' in state_dict and prefix + 'qkv_bias' not in state_dict:
+            q_bias, v_bias = state_dict.pop(prefix + 'q_bias'), state_dict.pop(prefix + 'v_bias')
+            state_dict[prefix + 'qkv_bias'] = torch.cat((q_bias, torch.zeros_like(q_bias), v_bias))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_relative_position_bias(self):
+        """
+        The bias only depends on cpb_mlp and buffers, so in eval mode without autograd it is computed once
+        and reused until the module is switched back to training, moved, or loaded from a state dict.
+        In-place edits of cpb_mlp's weights while in eval (e.g. EMA/SWA swaps) are not tracked; call eval() again
+        after them.
+
+        Returns:
+            relative position bias with shape of (num_heads, Wh*Ww, Wh*Ww)
+        """
+        # with autograd on (e.g. eval-mode fine-tuning) cpb_mlp must stay in the graph, so skip the cache
+        use_cache = not self.training and not torch.is_grad_enabled()
+        if use_cache and self._cached_bias is not None:
+            return self._cached_bias
+        # always built in fp32 so a cache filled under autocast is not reused at a lower precision
+        with torch.autocast(device_type=self.relative_coords_table.device.type, enabled=False):
+            relative_position_bias_table = self.cpb_mlp(self.relative_coords_table).view(-1, self.num_heads)
+        # gathering along the last dim of the transposed table yields (nH, Wh*Ww*Wh*Ww) directly, no permute + copy
+        relative_position_bias = relative_position_bias_table.t().index_select(1, self.relative_position_index_flat).view(
+            -1, self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1])  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = 16 * torch.sigmoid(relative_position_bias)
+        if use_cache:
+            self._cached_bias = relative_position_bias
+        return relative_position_bias
 
     def forward(self, x, mask=None):
         """
@@ -143,35 +192,34 @@ class WindowAttention(nn.Module):
         """
         B_, N, C = x.shape
         qkv_bias = None
-        if self.q_bias is not None:
-            qkv_bias = torch.cat((self.q_bias, torch.zeros_like(self.v_bias, requires_grad=False), self.v_bias))
-        qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
-        qkv = qkv.reshape(B_, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        if self.qkv_bias is not None:
+            qkv_bias = self.qkv_bias * self.qkv_bias_mask
+        # project on a 2D view so F.linear takes the addmm path instead of a batched matmul
+        qkv = F.linear(input=x.reshape(B_ * N, C), weight=self.qkv.weight, bias=qkv_bias)
+        qkv = qkv.view(B_, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        # cosine attention
-        attn = (F.normalize(q, dim=-1) @ F.normalize(k, dim=-1).transpose(-2, -1))
-        logit_scale = torch.clamp(self.logit_scale, max=torch.log(torch.tensor(1. / 0.01)).cuda()).exp()
-        attn = attn * logit_scale
+        # cosine attention, logit_scale is folded into q
+        logit_scale = torch.clamp(self.logit_scale, max=self.logit_scale_max).exp()
+        # same as F.normalize (eps=1e-12 on the norm), but the scale rides on the inverse norm of q;
+        # logit_scale is clamped in fp32, the per-row factors are cast back so q/k keep their autocast dtype
+        q = q * (torch.rsqrt(q.pow(2).sum(-1, keepdim=True).clamp_min(1e-24)) * logit_scale).to(q.dtype)
+        k = k * torch.rsqrt(k.pow(2).sum(-1, keepdim=True).clamp_min(1e-24)).to(k.dtype)
 
-        relative_position_bias_table = self.cpb_mlp(self.relative_coords_table).view(-1, self.num_heads)
-        relative_position_bias = relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        relative_position_bias = 16 * torch.sigmoid(relative_position_bias)
-        attn = attn + relative_position_bias.unsqueeze(0)
+        attn_bias = self.get_relative_position_bias()  # nH, Wh*Ww, Wh*Ww
 
         if mask is not None:
+            # fold windows into the head dim so the per-window mask broadcasts over the batch while SDPA stays 4-D
             nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+            q = q.reshape(B_ // nW, nW * self.num_heads, N, -1)
+            k = k.reshape(B_ // nW, nW * self.num_heads, N, -1)
+            v = v.reshape(B_ // nW, nW * self.num_heads, N, -1)
+            attn_bias = (attn_bias + mask.unsqueeze(1)).view(nW * self.num_heads, N, N)
+
+        # the bias is passed as attn_mask so it is added inside the fused attention kernel
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias.to(k.dtype),
+                                           dropout_p=self.attn_drop.p if self.training else 0., scale=1.)
+        x = x.reshape(B_, self.num_heads, N, -1).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -200,7 +248,8 @@ class SegmentMerging(nn.Module):
         self.norm = norm_layer(2 * dim)
 
     def forward(self, x):
-        return self.norm(rearrange(x, 'b (p d) c -> b p (d c)', d=2))
+        B, P, C = x.shape
+        return self.norm(x.reshape(B, P // 2, 2 * C)) # 'b (p d) c -> b p (d c)', d=2
 
 class FullAttention(nn.Module):
     '''
@@ -212,14 +261,10 @@ class FullAttention(nn.Module):
         self.dropout = nn.Dropout(attention_dropout)
         
     def forward(self, queries, keys, values):
-        B, L, H, E = queries.shape
-        _, S, _, D = values.shape
-        scale = self.scale or 1./torch.sqrt(torch.tensor(E).cuda())
-
-        scores = torch.einsum("blhe,bshe->bhls", queries, keys)
-        A = self.dropout(torch.softmax(scale * scores, dim=-1))
-        V = torch.einsum("bhls,bshd->blhd", A, values)
-        V = V + queries
+        # [B, L, H, E] => [B, H, L, E]; scale=None falls back to 1/sqrt(E)
+        V = F.scaled_dot_product_attention(queries.transpose(1, 2), keys.transpose(1, 2), values.transpose(1, 2),
+                                           dropout_p=self.dropout.p if self.training else 0., scale=self.scale)
+        V = V.transpose(1, 2) + queries
         return V.contiguous()
 
 
@@ -233,7 +278,7 @@ class AttentionLayer(nn.Module):
         d_keys = d_keys or (d_model//n_heads)
         d_values = d_values or (d_model//n_heads)
 
-        self.inner_attention = FullAttention(scale=None, attention_dropout = dropout)
+        self.inner_attention = FullAttention(scale=d_keys ** -0.5, attention_dropout = dropout)
         self.query_projection = nn.Linear(d_model, d_keys * n_heads)
         self.key_projection = nn.Linear(d_model, d_keys * n_heads)
         self.value_projection = nn.Linear(d_model, d_values * n_heads)
@@ -249,7 +294,11 @@ class AttentionLayer(nn.Module):
         _, S, _ = keys.shape
         H = self.n_heads
 
-        queries, keys, values = self.norm(queries), self.norm(keys), self.norm(values)
+        queries = self.norm(queries)
+        if keys is values: # decoder passes the same tensor as keys and values, normalize it once
+            keys = values = self.norm(keys)
+        else:
+            keys, values = self.norm(keys), self.norm(values)
         queries = self.query_projection(queries).view(B, L, H, -1)
         keys = self.key_projection(keys).view(B, S, H, -1)
         values = self.value_projection(values).view(B, S, H, -1)
@@ -267,20 +316,25 @@ class AttentionLayer(nn.Module):
 
 class HUTformer(nn.Module):
    
-    def __init__(self, NUM_NODES=207, len_hist=288, len_pred=288, len_patch=12, mode='encoder', pre_train=None):
+    def __init__(self, NUM_NODES=207, len_hist=288, len_pred=288, len_patch=12, mode='encoder', pre_train=None, amp_dtype=None, compile_mode=None, verbose=False):
         super(HUTformer, self).__init__()
         assert mode in ['encoder', 'decoder']
         self.mode       = mode
+        self.amp_dtype  = amp_dtype # e.g. torch.bfloat16 to run forward under autocast, None keeps fp32
         self.NUM_NODES  = NUM_NODES
         self.len_hist   = len_hist
         self.len_pred   = len_pred
         self.len_patch  = len_patch
-        self.num_patch  = int(len_hist / len_patch)
+        assert len_hist % len_patch == 0, 'len_hist must be a multiple of len_patch'
+        self.num_patch  = len_hist // len_patch
+        # encoder_3 windows are (2, num_patch/8) wide, and a width of 1 breaks the relative coordinate normalization
+        assert self.num_patch % 8 == 0 and self.num_patch >= 16, 'num_patch must be a multiple of 8 and at least 16'
         self.num_heads  = 8
         self.drop       = 0.1
         self.embed_dim  = 64
         self.dim_SE     = 16
         self.dim_U      = self.num_patch*self.embed_dim
+        np2, np4, np8   = self.num_patch // 2, self.num_patch // 4, self.num_patch // 8
 
         self.SE = nn.Parameter(torch.zeros(NUM_NODES, self.dim_SE))
         trunc_normal_(self.SE, std=.02)
@@ -288,33 +342,40 @@ class HUTformer(nn.Module):
         trunc_normal_(self.embedding.weight, std=.02)
         self.STPE = nn.Linear(self.num_patch*self.embed_dim+self.dim_SE+2, self.dim_U)
 
-        self.encoder_1 = WindowAttention(dim=self.embed_dim, window_size=(2, int(self.num_patch/2)), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop)
+        self.encoder_1 = WindowAttention(dim=self.embed_dim, window_size=(2, np2), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop)
         self.encoder_2 = nn.Sequential(SegmentMerging(dim=self.embed_dim, norm_layer=nn.LayerNorm),
-                            WindowAttention(dim=int(self.embed_dim*2), window_size=(2, int(self.num_patch/4)), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
+                            WindowAttention(dim=int(self.embed_dim*2), window_size=(2, np4), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
         self.encoder_3 = nn.Sequential(SegmentMerging(dim=int(self.embed_dim*2), norm_layer=nn.LayerNorm),
-                            WindowAttention(dim=int(self.embed_dim*4), window_size=(2, int(self.num_patch/8)), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
+                            WindowAttention(dim=int(self.embed_dim*4), window_size=(2, np8), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
         self.encoder_project = nn.Linear(self.dim_U, self.len_pred)
+        if compile_mode is not None: # e.g. 'max-autotune', fuses SegmentMerging's norm into the following WindowAttention
+            self.encoder_2.compile(mode=compile_mode)
+            self.encoder_3.compile(mode=compile_mode)
         if self.mode == 'encoder':
             return
         if pre_train is not None:
             self.load_state_dict(torch.load(pre_train)["model_state_dict"], strict=False)
             print('Load encoder weights.')
         
-        self.decoder_1 = WindowAttention(dim=self.embed_dim, window_size=(2, int(self.num_patch/2)), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop)
+        self.decoder_1 = WindowAttention(dim=self.embed_dim, window_size=(2, np2), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop)
         self.decoder_project_0 = nn.Linear(int(self.embed_dim*2), self.embed_dim)
         self.decoder_2 = nn.Sequential(AttentionLayer(d_model=self.embed_dim, n_heads=self.num_heads, mix=True, dropout = self.drop),
-                                       WindowAttention(dim=self.embed_dim, window_size=(2, int(self.num_patch/2)), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
+                                       WindowAttention(dim=self.embed_dim, window_size=(2, np2), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
         self.decoder_3 = nn.Sequential(AttentionLayer(d_model=self.embed_dim, n_heads=self.num_heads, mix=True, dropout = self.drop),
-                                       WindowAttention(dim=self.embed_dim, window_size=(2, int(self.num_patch/2)), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
+                                       WindowAttention(dim=self.embed_dim, window_size=(2, np2), num_heads=self.num_heads, qkv_bias=True, attn_drop=self.drop, proj_drop=self.drop))
         self.decoder_project = nn.Linear(self.embed_dim, self.len_patch)
+        if compile_mode is not None:
+            self.decoder_2.compile(mode=compile_mode)
+            self.decoder_3.compile(mode=compile_mode)
         
         if mode == 'decoder':
             for (name, para) in self.named_parameters():
                 if not ('decoder' in name): para.requires_grad = False
             print('Froze encoder parameters.')
-        import pandas as pd
-        pd.set_option('display.max_rows', 100)
-        print(pd.DataFrame(np.array([[name, para.requires_grad] for (name, para) in self.named_parameters()]), columns=['name', 'requires_grad']))
+        if verbose:
+            print(f"{'name':<60} requires_grad")
+            for (name, para) in self.named_parameters():
+                print(f"{name:<60} {para.requires_grad}")
 
     
     def forward(self, history_data: torch.Tensor, future_data: torch.Tensor, batch_seen: int, epoch: int, train: bool, **kwargs) -> torch.Tensor:
@@ -328,27 +389,40 @@ class HUTformer(nn.Module):
         Returns:
             torch.Tensor: outputs with shape [B, L2, N, 1]
         """
+        # with amp_dtype=None any autocast the caller already has active stays in effect
+        autocast = contextlib.nullcontext() if self.amp_dtype is None else \
+            torch.autocast(device_type=history_data.device.type, dtype=self.amp_dtype)
+        with autocast:
+            prediction = self._forward(history_data, future_data)
+        return prediction if self.amp_dtype is None else prediction.to(history_data.dtype)
+
+    def patchify(self, series: torch.Tensor) -> torch.Tensor:
+        # 'b n (p t) -> b n p t', t=len_patch: [B, N, L] => [B, N, num_patch, len_patch]
+        B, N, _ = series.shape
+        return series.reshape((B, N, -1, self.len_patch))
+
+    def _forward(self, history_data: torch.Tensor, future_data: torch.Tensor) -> torch.Tensor:
         B, L, N, C = history_data.shape
-        patches = rearrange(history_data[:, :, :, 0].permute(0,2,1), 'b n (p t) -> b n p t', t=self.len_patch) # [B, N, num_patch, len_patch]
+        patches = self.patchify(history_data[:, :, :, 0].permute(0,2,1)) # [B, N, num_patch, len_patch]
         S = self.embedding(patches).reshape((B, N, -1)) # [B, N, num_patch * embed_dim]
         S = torch.cat([
-                S, self.SE.repeat(B, 1, 1), # [B, N, num_patch * embed_dim + dim_SE]
+                S, self.SE.expand(B, -1, -1), # [B, N, num_patch * embed_dim + dim_SE]
                 history_data[:, -1, :, 1:], # [B, N, C-1]
             ], dim=-1)
         U = self.STPE(S).reshape((B*N, -1, self.embed_dim)) # [B, N, dim_U] => [BN, self.num_patch, self.embed_dim]
         H_1 = self.encoder_1(U) # [BN, self.num_patch,   self.embed_dim]
         H_2 = self.encoder_2(H_1) # [BN, self.num_patch/2, self.embed_dim*2]
         H_3 = self.encoder_3(H_2) # [BN, self.num_patch/4, self.embed_dim*4]
-        predict_encoder = self.encoder_project(rearrange(H_3, '(b n) p d -> b n (p d)', b=B, n=N)) # [B, N, L]
+        predict_encoder = self.encoder_project(H_3.reshape((B, N, -1))) # [B, N, L]
 
         if self.mode == 'encoder':
             _prediction = predict_encoder.permute(0,2,1).unsqueeze(-1) # [B, L, N, 1]
             return _prediction
         
-        patches = rearrange(predict_encoder, 'b n (p t) -> b n p t', t=self.len_patch) # [B, N, num_patch, len_patch]
+        patches = self.patchify(predict_encoder) # [B, N, num_patch, len_patch]
         S = self.embedding(patches).reshape((B, N, -1)) # [B, N, num_patch * embed_dim]
         S = torch.cat([
-                S, self.SE.repeat(B, 1, 1), # [B, N, num_patch * embed_dim + dim_SE]
+                S, self.SE.expand(B, -1, -1), # [B, N, num_patch * embed_dim + dim_SE]
                 future_data[:, -1, :, 1:], # [B, N, C-1]
             ], dim=-1)
         U = self.STPE(S).reshape((B*N, -1, self.embed_dim)) # [B, N, dim_U] => [BN, self.num_patch, self.embed_dim]
@@ -359,3 +433,54 @@ class HUTformer(nn.Module):
         
         return prediction
 
+
+class CUDAGraphRunner:
+    '''
+    Captures an eval-mode HUTformer as a CUDA graph and replays it, removing kernel launch overhead for
+    low-batch inference. A graph is captured per (shape, dtype, device) of the inputs. The graph reads the
+    cached relative position bias of every WindowAttention, so it is re-captured whenever
+    WindowAttention.bias_generation moves on (eval(), .to(), load_state_dict).
+    '''
+    def __init__(self, model, num_warmup=3):
+        self.model = model
+        self.num_warmup = num_warmup
+        self.reset()
+
+    def reset(self):
+        self.graph = None
+        self.key = None
+        self.static_history = None
+        self.static_future = None
+        self.static_output = None
+
+    @torch.no_grad()
+    def capture(self, history_data, future_data):
+        assert not self.model.training, 'CUDA graph capture requires the model in eval mode'
+        self.reset()
+        self.static_history = history_data.clone()
+        self.static_future = future_data.clone()
+        # warm up on a side stream so lazy initialisation (cuBLAS handles, cached biases) happens outside capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup):
+                self.model(self.static_history, self.static_future, 0, 0, False)
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_output = self.model(self.static_history, self.static_future, 0, 0, False)
+        self.key = self._key(history_data, future_data)
+
+    @staticmethod
+    def _key(history_data, future_data):
+        return (history_data.shape, future_data.shape, history_data.dtype, history_data.device,
+                WindowAttention.bias_generation)
+
+    @torch.no_grad()
+    def __call__(self, history_data, future_data):
+        if self.graph is None or self.key != self._key(history_data, future_data):
+            self.capture(history_data, future_data)
+        self.static_history.copy_(history_data)
+        self.static_future.copy_(future_data)
+        self.graph.replay()
+        return self.static_output.clone()
@@ -0,0 +1,101 @@
+import pytest
+import torch
+
+from HUTformer import HUTformer, CUDAGraphRunner, WindowAttention, SegmentMerging
+
+cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs need a GPU')
+
+
+def _inputs(B=2, L=288, N=5, C=3):
+    return torch.randn(B, L, N, C, device='cuda'), torch.randn(B, L, N, C, device='cuda')
+
+
+@cuda
+@pytest.mark.parametrize('mode', ['encoder', 'decoder'])
+def test_cuda_graph_runner_matches_eager(mode):
+    torch.manual_seed(0)
+    model = HUTformer(NUM_NODES=5, mode=mode).cuda().eval()
+    runner = CUDAGraphRunner(model)
+    for _ in range(2): # first call captures, second replays
+        history_data, future_data = _inputs()
+        with torch.no_grad():
+            expected = model(history_data, future_data, 0, 0, False)
+        torch.testing.assert_close(runner(history_data, future_data), expected)
+
+
+@cuda
+def test_cuda_graph_runner_recaptures_on_replaced_bias():
+    torch.manual_seed(0)
+    model = HUTformer(NUM_NODES=5, mode='decoder').cuda().eval()
+    runner = CUDAGraphRunner(model)
+    history_data, future_data = _inputs()
+    runner(history_data, future_data)
+    graph = runner.graph
+
+    model.eval() # replaces every cached relative position bias
+    with torch.no_grad():
+        expected = model(history_data, future_data, 0, 0, False)
+    torch.testing.assert_close(runner(history_data, future_data), expected)
+    assert runner.graph is not graph
+    graph = runner.graph
+
+    with torch.no_grad():
+        for para in model.decoder_1.cpb_mlp.parameters():
+            para.add_(1.0)
+    model.eval() # in-place weight edits in eval need eval() again to refresh the cached bias
+    with torch.no_grad():
+        expected = model(history_data, future_data, 0, 0, False)
+    torch.testing.assert_close(runner(history_data, future_data), expected)
+    assert runner.graph is not graph
+
+
+def test_bias_generation_moves_when_cached_bias_is_dropped():
+    model = HUTformer(NUM_NODES=5, mode='decoder').eval()
+    state_dict = model.state_dict()
+    for drop in (model.eval, model.double, lambda: model.load_state_dict(state_dict)):
+        generation = WindowAttention.bias_generation
+        drop()
+        assert WindowAttention.bias_generation > generation
+    generation = WindowAttention.bias_generation
+    history_data = torch.randn(2, 288, 5, 3, dtype=torch.float64)
+    with torch.no_grad():
+        model(history_data, history_data, 0, 0, False) # filling the cache is not a replacement
+    assert WindowAttention.bias_generation == generation
+
+
+def test_segment_merging_matches_index_construction():
+    merging = SegmentMerging(dim=4)
+    x = torch.randn(3, 6, 4)
+    # 'b (p d) c -> b p (d c)', d=2: segment p is the concatenation of tokens 2p and 2p+1
+    expected = merging.norm(torch.cat([x[:, 0::2], x[:, 1::2]], -1))
+    torch.testing.assert_close(merging(x), expected, rtol=0, atol=0)
+
+
+def test_patchify_matches_index_construction():
+    model = HUTformer(NUM_NODES=5, len_hist=192, len_pred=192, len_patch=12)
+    series = torch.randn(2, 5, 192)
+    # 'b n (p t) -> b n p t', t=len_patch: patch p covers time steps [p*t, (p+1)*t)
+    expected = torch.stack([series[:, :, p * 12:(p + 1) * 12] for p in range(16)], 2)
+    torch.testing.assert_close(model.patchify(series), expected, rtol=0, atol=0)
+
+
+def test_load_legacy_q_v_bias_state_dict():
+    torch.manual_seed(0)
+    model = HUTformer(NUM_NODES=5, mode='decoder')
+    # checkpoints from before qkv_bias stored separate q_bias/v_bias parameters
+    state_dict = {}
+    for (name, tensor) in model.state_dict().items():
+        if name.endswith('qkv_bias'):
+            prefix, dim = name[:-len('qkv_bias')], tensor.shape[0] // 3
+            state_dict[prefix + 'q_bias'] = torch.randn(dim)
+            state_dict[prefix + 'v_bias'] = torch.randn(dim)
+        else:
+            state_dict[name] = tensor
+    model.load_state_dict(state_dict) # strict
+
+    for (name, tensor) in model.state_dict().items():
+        if name.endswith('qkv_bias'):
+            prefix, dim = name[:-len('qkv_bias')], tensor.shape[0] // 3
+            torch.testing.assert_close(tensor[:dim], state_dict[prefix + 'q_bias'])
+            assert torch.count_nonzero(tensor[dim:2 * dim]) == 0
+            torch.testing.assert_close(tensor[2 * dim:], state_dict[prefix + 'v_bias'])